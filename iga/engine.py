@@ -1,14 +1,13 @@
-from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
 import sys
 import time
 from typing import TypeAlias
 import cli
 import enum
-import random
+import numpy as np
 
-class CellState(enum.Enum):
+class CellState(enum.IntEnum):
     """The state of a cell in a grid."""
 
     DEAD = 0
@@ -23,8 +22,40 @@ class CellState(enum.Enum):
         else:
             return "⧫"
 
+# glyph of every cell state, indexed by the state itself
+_GLYPHS = np.array([str(state) for state in CellState])
+
+# next state of every cell, indexed by its state * 9 + its number of alive neighbours
+_TRANSITIONS = np.array([
+    [CellState.DEAD] * 3 + [CellState.ALIVE] * 3 + [CellState.DEAD] * 3, # born with 3 to 5 alive neighbours
+    [CellState.DEAD] * 2 + [CellState.ALIVE] * 4 + [CellState.DEAD] * 3, # dies of under or overpopulation
+    [CellState.SUPERPOSITION] * 9, # collapsed separately once observed
+], dtype=np.uint8).ravel()
+
 Point: TypeAlias = tuple[int, int]
 
+# (dy, dx) offsets of the eight neighbours of a cell
+_NEIGHBOUR_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+def _active_span(occupied: np.ndarray) -> slice:
+    """Get the span of an axis that can change in the next iteration.
+
+    Cells without a non-dead neighbour stay dead, so only the occupied span plus one
+    cell on each side has to be iterated. If that does not fit inside the axis, the
+    whole axis is used so that the neighbours wrap around the edges.
+
+    Args:
+        occupied: Whether each row (or column) contains a non-dead cell
+
+    Returns:
+        The span of rows (or columns) to iterate
+
+    """
+    indices = np.flatnonzero(occupied)
+    if indices.size and indices[0] >= 1 and indices[-1] <= occupied.size - 2:
+        return slice(int(indices[0]) - 1, int(indices[-1]) + 2)
+    return slice(0, occupied.size)
+
 @dataclass(slots=True)
 class Engine:
     """The engine that runs the simulation."""
@@ -32,39 +63,60 @@ class Engine:
     config: cli.Config = None
     width: int = None
     height: int = None
-    cells: list[list[CellState]] = None
+    # recycled as the buffer of the next grid every tick, so a grid passed in is copied first
+    cells: np.ndarray = None
     entangled: dict[Point, Point] = None
+    _rng: np.random.Generator = field(default=None, init=False, repr=False)
+    # the grid from the previous iteration, reused to hold the next one
+    _spare_cells: np.ndarray = field(default=None, init=False, repr=False)
+    # scratch buffers for iterate, sized for the whole grid once (a smaller window uses their top left corner)
+    _padded_alive: np.ndarray = field(default=None, init=False, repr=False)
+    _row_sums: np.ndarray = field(default=None, init=False, repr=False)
+    _cell_codes: np.ndarray = field(default=None, init=False, repr=False)
+    # the glyphs of the displayed grid, with an extra newline column
+    _frame: np.ndarray = field(default=None, init=False, repr=False)
 
     def __post_init__(self):
         """Post-initialization hook."""
-        random.seed(self.config.seed)
         self.entangled = self.entangled or {}
         self.config = self.config or cli.Config()
+        # like random.seed, a negative seed uses its absolute value
+        self._rng = np.random.default_rng(abs(self.config.seed))
 
         self.width = self.width or self.config.width
         self.height = self.height or self.config.height
-        # based on the start alive probability, randomly generate the cells
-        self.cells = self.cells or [[CellState.ALIVE if random.random() < self.config.start_alive_prob else CellState.DEAD for _ in range(self.width)] for _ in range(self.height)]
 
         if self.width <= 0:
             raise ValueError("width must be positive")
         if self.height <= 0:
             raise ValueError("height must be positive")
-        if len(self.cells) != self.height:
+
+        if self.cells is None:
+            # based on the start alive probability, randomly generate the cells
+            self.cells = (self._rng.random((self.height, self.width)) < self.config.start_alive_prob).astype(np.uint8)
+        else:
+            self.cells = np.array(self.cells, dtype=np.uint8)
+
+        if self.cells.ndim != 2 or self.cells.shape[0] != self.height:
             raise ValueError("number of rows must equal height")
-        for row in self.cells:
-            if len(row) != self.width:
-                raise ValueError("number of columns must equal width")
+        if self.cells.shape[1] != self.width:
+            raise ValueError("number of columns must equal width")
+
+        self._spare_cells = np.empty_like(self.cells)
+        self._padded_alive = np.empty((self.height + 2, self.width + 2), dtype=np.uint8)
+        self._row_sums = np.empty((self.height + 2, self.width), dtype=np.uint8)
+        self._cell_codes = np.empty_like(self.cells)
+        self._frame = np.full((self.height, self.width + 1), "\n", dtype=_GLYPHS.dtype)
             
     def __getitem__(self, key):
         """Get the cell at the given position."""
         y, x = key
-        return self.cells[y % self.height][x % self.width]
+        return self.cells[y % self.height, x % self.width]
     
     def __setitem__(self, key, value):
         """Set the cell at the given position."""
         y, x = key
-        self.cells[y % self.height][x % self.width] = value
+        self.cells[y % self.height, x % self.width] = value
 
     def __iter__(self):
         """Iterate over the cells in the grid."""
@@ -76,7 +128,7 @@ class Engine:
     
     def __eq__(self, other):
         """Check if two grids are equal."""
-        return self.width == other.width and self.height == other.height and self.cells == other.cells
+        return self.width == other.width and self.height == other.height and np.array_equal(self.cells, other.cells)
     
     def __ne__(self, other):
         """Check if two grids are not equal."""
@@ -86,30 +138,11 @@ class Engine:
         """Check if the grid contains the given cell."""
         return item in self.cells
     
-    def get_neighbours(self, x, y) -> list[tuple[CellState, Point]]:
-        """Get the neighbours of the cell at the given position."""
-        return [
-            (self[y - 1, x - 1], (x - 1, y - 1)),
-            (self[y - 1, x], (x, y - 1)),
-            (self[y - 1, x + 1], (x + 1, y - 1)),
-            (self[y, x - 1], (x - 1, y)),
-            (self[y, x + 1], (x + 1, y)),
-            (self[y + 1, x - 1], (x - 1, y + 1)),
-            (self[y + 1, x], (x, y + 1)),
-            (self[y + 1, x + 1], (x + 1, y + 1)),
-        ]
-    
     def link(self, x1, y1, x2, y2):
         """Link two cells together."""
         
-        # make sure both cells are not already linked
-        if (x1, y1) in self.entangled:
-            return
-        if (x2, y2) in self.entangled:
-            return
-            
-        # make sure both cells are not the same
-        if (x1, y1) == (x2, y2):
+        # make sure both cells are not the same and not already linked
+        if (x1, y1) == (x2, y2) or (x1, y1) in self.entangled or (x2, y2) in self.entangled:
             return
             
         self.entangled[(x1, y1)] = (x2, y2)
@@ -117,106 +150,167 @@ class Engine:
 
     def unlink(self, x1, y1, x2, y2):
         """Unlink two cells."""    
-        # make sure both cells are linked
-        if (x1, y1) not in self.entangled:
-            return
-        if (x2, y2) not in self.entangled:
-            return
-            
-        # make sure both cells are not the same
-        if (x1, y1) == (x2, y2):
+        # make sure the cells are linked to each other (a cell is never linked to itself)
+        if self.entangled.get((x1, y1)) != (x2, y2):
             return
             
         del self.entangled[(x1, y1)]
         del self.entangled[(x2, y2)]
 
-    def iterate(self):
+    def iterate(self) -> bool:
+        """Advance the grid by one iteration.
+
+        Returns:
+            Whether a stable state was reached
+
+        """
+        # plain ints, numpy looks up its protocol attributes on the enum class whenever it compares against a member
+        DEAD, ALIVE, SUPERPOSITION = int(CellState.DEAD), int(CellState.ALIVE), int(CellState.SUPERPOSITION)
+
         current_cells = self.cells
-        next_cells = deepcopy(current_cells)
-
-        for y in range(self.height):
-            for x in range(self.width):
-                neighbours = self.get_neighbours(x, y)
-                alive_neighbours = sum(neighbour[0] == CellState.ALIVE for neighbour in neighbours)
-
-                if current_cells[y % self.height][x % self.width] == CellState.DEAD and alive_neighbours in (3, 4, 5):
-                    next_cells[y % self.height][x % self.width] = CellState.ALIVE
-
-                    if alive_neighbours == 4:
-                        for neighbour in neighbours:
-                            if neighbour[0] == CellState.ALIVE:
-                                self.link(x, y, neighbour[1][0], neighbour[1][1])
-
-                                # put into superposition
-                                next_cells[y % self.height][x % self.width] = CellState.SUPERPOSITION
-                                next_cells[neighbour[1][1] % self.height][neighbour[1][0] % self.width] = CellState.SUPERPOSITION
-
-                elif current_cells[y % self.height][x % self.width] == CellState.ALIVE and (alive_neighbours > 5 or alive_neighbours < 2):
-                    next_cells[y % self.height][x % self.width] = CellState.DEAD
-
-                elif current_cells[y % self.height][x % self.width] == CellState.SUPERPOSITION and alive_neighbours > 0:
-                    # collapse the superposition of the observed particle
-                    next_cells[y % self.height][x % self.width] = random.choice([CellState.ALIVE, CellState.DEAD])
-
-                    # check for entanglements
-                    other_cell = self.entangled.get((x, y), None)
-                    if other_cell is not None:
-                        
-                        # get the other cell
-                        other_cell_state = current_cells[other_cell[1] % self.height][other_cell[0] % self.width]
-                        
-                        if other_cell_state == CellState.SUPERPOSITION:
-                            # collapse the other cell (in reality this would be the difference in spin between the two particles but our quantum states are binary)
-                            next_cells[other_cell[1] % self.height][other_cell[0] % self.width] = CellState.DEAD if next_cells[y % self.height][x % self.width] == CellState.ALIVE else CellState.ALIVE
-
-                        # unlink the two cells
-                        self.unlink(x, y, other_cell[0], other_cell[1])
-
-                        break
-
-        # make it official
-        if self.cells == next_cells:
+        height, width = self.height, self.width
+
+        # only the window around the non-dead cells can change, everything else stays dead
+        window = (_active_span(current_cells.any(axis=1)), _active_span(current_cells.any(axis=0)))
+        active_cells = current_cells[window]
+
+        rows, cols = active_cells.shape
+        alive = self._padded_alive[:rows + 2, :cols + 2]
+        row_sums = self._row_sums[:rows + 2, :cols]
+        cell_codes = self._cell_codes[:rows, :cols]
+
+        # count the alive neighbours of every cell at once (a 3x3 convolution) from a 0/1 byte mask whose padding
+        # wraps around the edges (a window smaller than the grid has dead edges, so there it just pads with dead cells)
+        np.equal(active_cells, ALIVE, out=alive[1:-1, 1:-1])
+        alive[0, 1:-1] = alive[-2, 1:-1]
+        alive[-1, 1:-1] = alive[1, 1:-1]
+        alive[:, 0] = alive[:, -2]
+        alive[:, -1] = alive[:, 1]
+
+        # the 3x3 box is separable: sum each row triple first, then each column triple of those sums, minus the cell itself;
+        # the counts are added onto state * 9, folding the state and neighbour count of every cell into one code
+        np.add(alive[:, :-2], alive[:, 1:-1], out=row_sums)
+        row_sums += alive[:, 2:]
+        np.multiply(active_cells, 9, out=cell_codes)
+        cell_codes += row_sums[:-2]
+        cell_codes += row_sums[1:-1]
+        cell_codes += row_sums[2:]
+        cell_codes -= alive[1:-1, 1:-1]
+
+        # apply all the rules in a single lookup
+        next_cells = self._spare_cells
+        if active_cells.size != next_cells.size:
+            next_cells.fill(DEAD)
+        np.take(_TRANSITIONS, cell_codes, out=next_cells[window])
+        window_origin = (window[0].start, window[1].start)
+
+        # superpositions with any alive neighbour are observed
+        observed = (np.argwhere(cell_codes > SUPERPOSITION * 9) + window_origin).tolist()
+        # draw all the collapses at once, 0 and 1 being DEAD and ALIVE
+        collapsed_states = self._rng.integers(2, size=len(observed), dtype=np.uint8).tolist()
+        for (y, x), collapsed_state in zip(observed, collapsed_states):
+            if next_cells[y, x] != SUPERPOSITION:
+                # already collapsed by its entangled partner
+                continue
+
+            # collapse the superposition of the observed particle
+            next_cells[y, x] = collapsed_state
+
+            # check for entanglements
+            other_cell = self.entangled.get((x, y), None)
+            if other_cell is not None:
+                # links passed in from outside may not be wrapped into the grid
+                other_x, other_y = other_cell
+                wrapped_y, wrapped_x = other_y % height, other_x % width
+
+                if current_cells[wrapped_y, wrapped_x] == SUPERPOSITION:
+                    # collapse the other cell (in reality this would be the difference in spin between the two particles but our quantum states are binary)
+                    next_cells[wrapped_y, wrapped_x] = DEAD if next_cells[y, x] == ALIVE else ALIVE
+
+                # unlink the two cells
+                self.unlink(x, y, other_x, other_y)
+
+        # births next to exactly four alive cells get entangled with them instead
+        entangled_births = (np.argwhere(cell_codes == DEAD * 9 + 4) + window_origin).tolist()
+        for y, x in entangled_births:
+            for dy, dx in _NEIGHBOUR_OFFSETS:
+                ny, nx = (y + dy) % height, (x + dx) % width
+                if current_cells[ny, nx] == ALIVE:
+                    self.link(x, y, nx, ny)
+
+                    # put into superposition, unless the neighbour comes after this cell in row-major order
+                    # and dies of under or overpopulation itself, in which case its own rule has the last word
+                    next_cells[y, x] = SUPERPOSITION
+                    if (ny, nx) < (y, x) or next_cells[ny, nx] != DEAD:
+                        next_cells[ny, nx] = SUPERPOSITION
+
+        # make it official; collapses and entangled births always change a cell,
+        # otherwise only the window can differ since everything outside it stays dead
+        stable = not observed and not entangled_births and np.array_equal(active_cells, next_cells[window])
+        if stable:
             # if the cells are the same, we have reached a stable state
             self.config.max_iter = 0
-            print("Stable state reached")
-        self.cells = next_cells
+        self._spare_cells, self.cells = current_cells, next_cells
+        return stable
 
     def display(self, iteration: int = 0, cur_sec_iter_count: int = 0):
         """Display the grid."""
 
+        # look up the glyph of every cell in front of the newline column, then read the frame back as one string
+        frame = self._frame
+        np.take(_GLYPHS, self.cells, out=frame[:, :-1])
+
         # make sure we overwrite the previous grid
         print_str = "\033[2J"
-        print_str += "\n".join(["".join([str(cell) for cell in row]) for row in self.cells])
-        status_str = f"Entangled: {len(self.entangled):>5} | Iteration: {iteration:>5} | Iterations per second: {cur_sec_iter_count:>5} | Seed: {self.config.seed:>5}"
+        print_str += frame.reshape(-1).view(f"<U{frame.size}")[0]
+        status_str = f"Entangled: {len(self.entangled) // 2:>5} | Iteration: {iteration:>5} | Iterations per second: {cur_sec_iter_count:>5} | Seed: {self.config.seed:>5}"
 
-        # Print the status string
-        sys.stdout.write(f"{print_str}\n{status_str}\n")
+        # encode the grid and the status string once and write them with as few syscalls as possible,
+        # after anything still buffered in sys.stdout
         sys.stdout.flush()
+        buf = memoryview(f"{print_str}{status_str}\n".encode())
+        fd = sys.stdout.fileno()
+        while buf:
+            buf = buf[os.write(fd, buf):]
 
     def loop(self):
         """Run the simulation."""
 
-        last_iter_time = time.time()
+        # all timing is done in integer nanoseconds of the monotonic clock, read once per iteration
+        iter_interval_ns = 1_000_000_000 // self.config.ips
+        # the terminal can't keep up with fast simulations, so frames are dropped to draw at most 60 per second
+        display_interval_ns = 1_000_000_000 // min(self.config.ips, 60)
+        last_iter_ns = time.monotonic_ns()
+        last_display_ns = last_iter_ns - display_interval_ns
         cur_sec_iter_count = 0
-        cur_sec = time.time() // 1
+        cur_sec = last_iter_ns // 1_000_000_000
         last_ips = 0
         iterations = 0
-        sleep_time = 0
+        stable = False
         while iterations < self.config.max_iter or self.config.max_iter == -1:
-            self.display(iterations, last_ips)
-            self.iterate()
+            if last_iter_ns - last_display_ns >= display_interval_ns:
+                self.display(iterations, last_ips)
+                last_display_ns = last_iter_ns
+            stable = self.iterate()
 
             # sleep for the remaining time to get the desired iterations per second
-            sleep_time = 1 / self.config.ips - (time.time() - last_iter_time)
-            if sleep_time > 0:
-                time.sleep(sleep_time)
+            now = time.monotonic_ns()
+            sleep_ns = last_iter_ns + iter_interval_ns - now
+            if sleep_ns > 0:
+                time.sleep(sleep_ns / 1e9)
+                now = time.monotonic_ns()
 
-            last_iter_time = time.time()
+            last_iter_ns = now
             iterations += 1
 
             # update the iterations per second
             cur_sec_iter_count += 1
-            if time.time() // 1 != cur_sec:
-                last_ips = round(cur_sec_iter_count / (time.time() - cur_sec), 2)
+            if now // 1_000_000_000 != cur_sec:
+                last_ips = round(cur_sec_iter_count * 1e9 / (now - cur_sec * 1_000_000_000), 2)
                 cur_sec_iter_count = 0
-                cur_sec = time.time() // 1
\ No newline at end of file
+                cur_sec = now // 1_000_000_000
+
+        # frames are drawn before each iteration, so draw the final state too
+        self.display(iterations, last_ips)
+        if stable:
+            print("Stable state reached")
\ No newline at end of file